@@ -1,10 +1,13 @@
-from typing import Optional, List, Dict, Any, NamedTuple
+from typing import Optional, List, Dict, Any, NamedTuple, Union, TextIO, Callable
 from multiprocessing import Process
 import time
-from datetime import datetime
+import csv
+import itertools
+from datetime import datetime, timezone
 import os
 import logging
 import platform
+import signal
 
 from utils import get_conn, get_collection_filepath
 from gps import gps_receiver, NoGPSData
@@ -20,8 +23,22 @@ class StoredDataType(NamedTuple):
     unit: str
 
 
-# Period between Winsen sensor queries in seconds
-DATAPOINT_COLLECTION_INTERVAL_S: float = 5.0
+# Period between recorded datapoints in seconds, configurable from the environment variable $MSA_INTERVAL_S
+DATAPOINT_COLLECTION_INTERVAL_S: float = float(os.environ.get("MSA_INTERVAL_S", 5.0))
+
+# Read buffer used when loading collection files for visualization
+COLLECTION_READ_BUFFER_SIZE: int = 1 << 20
+
+# Maximum number of points per sensor returned for visualization, larger collects are sub-sampled
+MAX_VISUALIZED_POINTS: int = 2000
+
+# Write buffer for the collection file held open during a recording session
+COLLECTION_WRITE_BUFFER_SIZE: int = 1 << 16
+
+# Datapoints are held in memory and written to the SD card in batches of this many rows...
+DATAPOINT_FLUSH_COUNT: int = 32
+# ...or at least this often in seconds, whichever comes first
+DATAPOINT_FLUSH_INTERVAL_S: float = 60.0
 
 # Extra recorded column types from the GPS board
 KNOWN_DATA_COLUMNS = [StoredDataType(x.name, x.short_name, x.unit) for x in WINSEN_DATAPACKET] + [
@@ -33,53 +50,55 @@ KNOWN_DATA_COLUMNS = [StoredDataType(x.name, x.short_name, x.unit) for x in WINS
     StoredDataType('Position Dilution of Precision', 'dop', ''),
 ]
 
+# Metadata reported alongside each column's points, keyed by column short name
+_COLUMN_TEMPLATE: Dict[str, Dict[str, str]] = {
+    column.short_name: {'name': column.name, 'short_name': column.short_name, 'unit': column.unit}
+    for column in KNOWN_DATA_COLUMNS
+}
 
 def start_collection(description: Optional[str] = None) -> int:
     """Start a collection at the current time with an optional description string"""
     recorder.start_collection()
     # Wait 60 seconds for recording to start
-    for _ in range(600):
-        should_record, is_recording = recorder.get_recording_state()
-        if not should_record:
-            # Check if the user has hit the stop button before we started
-            logging.warning("Recording signal has been cancelled during start wait")
-            return -1
-
-        if is_recording:
-            collection_id = recorder.get_current_collection_id()
-            if description:
-                # Update the collection object in the database with the user provided description
-                db_conn = get_conn()
-                cur = db_conn.cursor()
-                cur.execute("""
-                    UPDATE collections
-                    SET description = ?
-                    WHERE id = ?
-                """, (description, collection_id))
-                db_conn.commit()
-                db_conn.close()
-            return collection_id
-        time.sleep(0.1)
-    raise RuntimeError("Recorder could not start")
+    should_record, is_recording = recorder.wait_for_recording_state(
+        lambda should_record, is_recording: is_recording or not should_record, timeout=60.0)
+    if not should_record:
+        # Check if the user has hit the stop button before we started
+        logging.warning("Recording signal has been cancelled during start wait")
+        return -1
+    if not is_recording:
+        raise RuntimeError("Recorder could not start")
+
+    collection_id = recorder.get_current_collection_id()
+    if description:
+        # Update the collection object in the database with the user provided description
+        db_conn = get_conn()
+        cur = db_conn.cursor()
+        cur.execute("""
+            UPDATE collections
+            SET description = ?
+            WHERE id = ?
+        """, (description, collection_id))
+        recorder_interface.signal_collections_changed()
+    return collection_id
 
 
 def stop_collection() -> int:
     """Stop an active collection session at the current time"""
     recorder.stop_collection()
     # Wait 60 seconds for recording to stop
-    for _ in range(600):
-        should_record, is_recording = recorder.get_recording_state()
-        if should_record:
-            # Check if the user has started a new collection session while we were waiting
-            logging.warning("Recording signal has been cancelled during stop wait")
-            return -1
+    should_record, is_recording = recorder.wait_for_recording_state(
+        lambda should_record, is_recording: should_record or not is_recording, timeout=60.0)
+    if should_record:
+        # Check if the user has started a new collection session while we were waiting
+        logging.warning("Recording signal has been cancelled during stop wait")
+        return -1
+    if is_recording:
+        raise RuntimeError("Recorder could not stop")
 
-        if not is_recording:
-            # Provide the API with the collection_id of the recently finished session
-            collection_id = recorder.get_current_collection_id()
-            return collection_id
-        time.sleep(0.1)
-    raise RuntimeError("Recorder could not stop")
+    # Provide the API with the collection_id of the recently finished session
+    collection_id = recorder.get_current_collection_id()
+    return collection_id
 
 
 def get_collection_list() -> List[Dict[str, Any]]:
@@ -104,10 +123,17 @@ def get_collection_list() -> List[Dict[str, Any]]:
             'description': description,
             'uploaded': uploaded,
         })
-    db_conn.close()
     return collection_response
 
 
+def _parse_value(value: str) -> Union[float, str]:
+    """Cast a recorded data point as a floating point value, falling back to the string representation"""
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
 def get_collection_details(collection_id: int) -> Dict[str, Any]:
     """Get detailed metadata about a single collection and list out data points"""
     db_conn = get_conn()
@@ -120,50 +146,51 @@ def get_collection_details(collection_id: int) -> Dict[str, Any]:
     """, (collection_id,))
     collection = cur.fetchone()
     name, start_s, end_s, uploaded, description = collection
-    db_conn.close()
     # Find the collected CSV on disk
     collection_filename = get_collection_filepath(name)
     if not os.path.exists(collection_filename):
         # Data doesn't exist (maybe uploaded and deleted?)
         data = []
     else:
-        # Open up the data collection and reformat the data for visualization
-        with open(collection_filename, 'r') as f:
-            all_data = f.readlines()
-        if not all_data:
+        # Stream the data collection, only parsing the rows to visualize
+        with open(collection_filename, 'r', newline='', buffering=COLLECTION_READ_BUFFER_SIZE) as f:
+            # First row contains column names, comma delimited
+            column_short_names = next(csv.reader(itertools.islice(f, 1)), None)
+            if column_short_names:
+                # Count the rows in a first pass so large collects can be sub-sampled down to an evenly spaced
+                # selection of rows, so that only those get parsed
+                row_count = sum(1 for _ in f)
+                stride = max(1, -(-row_count // MAX_VISUALIZED_POINTS))
+                f.seek(0)
+                # Rows that don't match the header (e.g. a partially written final line) are dropped rather than
+                # misaligning the columns
+                column_count = len(column_short_names)
+                rows = [row for row in csv.reader(itertools.islice(f, 1, None, stride)) if len(row) == column_count]
+        if not column_short_names:
             data = []
         else:
-            data_map = {}
-            # First row contains column names, comma delimited
-            column_short_names = all_data[0].strip().split(',')
+            data_map = {short_name: {**metadata, 'points': []} for short_name, metadata in _COLUMN_TEMPLATE.items()}
             # Separate out the time columns for use as the timeseries axis
-            date_idx = column_short_names.index('timestamp')
-            met_idx = column_short_names.index('met')
-            for column in KNOWN_DATA_COLUMNS:
-                data_map[column.short_name] = {
-                    'name': column.name,
-                    'short_name': column.short_name,
-                    'unit': column.unit,
-                    'points': []
-                }
-            for row in all_data[1:]:
-                # TODO: perform sub-sampling for large collects
-                entries = row.strip().split(',')
-                raw_timestamp = entries[date_idx]
-                for idx, value in enumerate(entries):
+            column_indices = {short_name: idx for idx, short_name in enumerate(column_short_names)}
+            date_idx = column_indices['timestamp']
+            met_idx = column_indices['met']
+            # Transpose into columns so each column is converted in a single pass
+            columns = list(zip(*rows))
+            if columns:
+                timestamps = columns[date_idx]
+                for idx, column in enumerate(columns):
                     # Don't report a timeseries for the time columns (is just the identity)
-                    if idx in [date_idx, met_idx]:
+                    if idx in (date_idx, met_idx):
                         continue
                     try:
-                        # Attempt to cast the data point as a floating point value
-                        typed_value = float(value)
-                    except:
-                        # Otherwise fall back to the string representation
-                        typed_value = value
-                    data_map[column_short_names[idx]]['points'].append({
-                        'ts': raw_timestamp,
-                        'value': typed_value
-                    })
+                        # Attempt to cast the whole column as floating point values
+                        typed_values = list(map(float, column))
+                    except ValueError:
+                        # Otherwise fall back to casting each data point individually
+                        typed_values = [_parse_value(value) for value in column]
+                    data_map[column_short_names[idx]]['points'] = [
+                        {'ts': ts, 'value': value} for ts, value in zip(timestamps, typed_values)
+                    ]
             # Reformat data map into a flat list
             data = [x for x in data_map.values() if x['points']]
     return {
@@ -177,12 +204,23 @@ def get_collection_details(collection_id: int) -> Dict[str, Any]:
     }
 
 
+def _exit_on_terminate(signum: int, frame: Any) -> None:
+    """Signal handler turning a termination request into a regular interpreter exit"""
+    raise SystemExit(0)
+
+
 class Recorder(Process):
     """Data logging process responsible for collecting data and saving to disk"""
     def __init__(self):
         # These variables only used in forked copy
         self._collection_name: str = 'UNKNOWN'
         self._true_start_s: float = 0.0
+        self._collection_file: Optional[TextIO] = None
+        self._pending_rows: List[str] = []  # Formatted rows not yet written to the collection file
+        self._last_flush_s: float = 0.0  # Time of the last write to the collection file
+        self._header_written: bool = False  # Whether the column names have been emitted for this collection
+        self._header_line: str = ''  # Comma delimited column names of the collection
+        self._row_format: str = ''  # Comma delimited format string matching the collection's columns
 
         # Call superclass in preparation of forking
         super(Recorder, self).__init__()
@@ -202,6 +240,16 @@ class Recorder(Process):
         """Return the current recording state"""
         return recorder_interface.get_recording_state()
 
+    @staticmethod
+    def wait_for_recording_state(predicate: Callable[[bool, bool], bool], timeout: float) -> (bool, bool):
+        """Wait for the recording state to satisfy predicate, returning the latest state"""
+        return recorder_interface.wait_for_recording_state(predicate, timeout)
+
+    @staticmethod
+    def get_collections_version() -> int:
+        """Return a counter that increases every time the stored collections are modified"""
+        return recorder_interface.get_collections_version()
+
     @staticmethod
     def get_current_collection_id() -> int:
         """Return the current collection id (if exists)"""
@@ -221,6 +269,15 @@ class Recorder(Process):
         """Main loop in forked process"""
         logging.info("Starting Recorder Daemon")
 
+        # Stopping the service terminates this process, unwind it normally so buffered datapoints still get written
+        signal.signal(signal.SIGTERM, _exit_on_terminate)
+        try:
+            self._record_collections()
+        finally:
+            self._close_collection_file()
+
+    def _record_collections(self) -> None:
+        """Start, record and stop collections as instructed, indefinitely"""
         last_datapoint_s: float = 0.0  # Time of the last recording cycle
         current_collection_id: int = -1  # Current collection database identifier
         current_datapoints: int = 0  # Current number of datapoints since collection start
@@ -255,7 +312,7 @@ class Recorder(Process):
 
                 # Check for sensor and gps data
                 try:
-                    collection_datetime = self._current_time_from_gps()
+                    collection_start_s = self._current_time_from_gps()
                 except NoGPSData:
                     logging.warning("No GPS lock, skipping collection start cycle")
                     failed_start_cycles += 1
@@ -271,8 +328,9 @@ class Recorder(Process):
 
                 # Start a new recording session
                 failed_start_cycles = 0
-                self._true_start_s = collection_datetime.timestamp()
+                self._true_start_s = collection_start_s
                 # Name the collection using the GPS time and hostname
+                collection_datetime = datetime.fromtimestamp(collection_start_s, timezone.utc)
                 self._collection_name: str = collection_datetime.strftime("%Y_%m_%d-%H_%M_%S") + f"-{platform.node()}"
                 cur = db_conn.cursor()
                 # Add the new collection metadata to the database
@@ -281,7 +339,8 @@ class Recorder(Process):
                     VALUES (?, ?)
                 """, (self._collection_name, self._true_start_s))
                 current_collection_id: int = cur.lastrowid
-                db_conn.commit()
+                recorder_interface.signal_collections_changed()
+                self._open_collection_file()
                 current_local_start_s = time.time()
                 current_datapoints = 0
                 # Let the user know that we've started recording
@@ -295,7 +354,7 @@ class Recorder(Process):
                 # Close out existing collection
                 cur = db_conn.cursor()
                 try:
-                    end_s = self._current_time_from_gps().timestamp()
+                    end_s = self._current_time_from_gps()
                 except NoGPSData:
                     logging.warning("No GPS lock, skipping cycle")
                     time.sleep(0.5)
@@ -306,7 +365,8 @@ class Recorder(Process):
                     SET end_s = ?
                     WHERE id = ?
                 """, (end_s, current_collection_id))
-                db_conn.commit()
+                recorder_interface.signal_collections_changed()
+                self._close_collection_file()
                 sensor_receiver.stop_collect()
                 recorder_interface.acknowledge_is_recording(False)
                 continue
@@ -322,10 +382,40 @@ class Recorder(Process):
                 last_datapoint_s = time.time()
 
     @staticmethod
-    def _current_time_from_gps() -> datetime:
-        """Get the current true time from the GPS"""
+    def _current_time_from_gps() -> float:
+        """Get the current true time from the GPS in seconds since the UTC epoch"""
         return gps_receiver.get_current_status()[0].timestamp
 
+    def _open_collection_file(self) -> None:
+        """Open the collection file for a new session and keep it open for appending datapoints"""
+        # Append so that a session reusing an existing collection name never truncates the earlier session's data
+        self._collection_file = open(get_collection_filepath(self._collection_name), 'a',
+                                     buffering=COLLECTION_WRITE_BUFFER_SIZE)
+        # The column layout is fixed for the whole collection, so it only needs to be computed once
+        column_names = ['timestamp', 'met', 'lat', 'lon', 'alt', 'dop'] + [x.short_name for x in WINSEN_DATAPACKET]
+        self._header_line = f"{','.join(column_names)}\n"
+        self._row_format = ','.join(['%s'] * len(column_names)) + '\n'
+        # Only a new (empty) file needs to start with the column names
+        self._header_written = self._collection_file.tell() > 0
+        self._pending_rows.clear()
+        self._last_flush_s = time.time()
+
+    def _flush_pending_rows(self) -> None:
+        """Write all buffered datapoints to the collection file in a single batch"""
+        # Take the batch before writing it, so a flush interrupted by termination can't write the same rows again
+        rows, self._pending_rows = self._pending_rows, []
+        self._collection_file.writelines(rows)
+        self._collection_file.flush()
+        self._last_flush_s = time.time()
+
+    def _close_collection_file(self) -> None:
+        """Close out the collection file of the current session"""
+        if self._collection_file is not None:
+            self._flush_pending_rows()
+            # Detach the file before closing it, so a close interrupted by termination isn't repeated on a closed file
+            collection_file, self._collection_file = self._collection_file, None
+            collection_file.close()
+
     def _record_new_datapoint(self) -> None:
         """Record a single GPS/Winsen data point to disk"""
         try:
@@ -347,20 +437,23 @@ class Recorder(Process):
             logging.warning(f"GPS latency currently at {gps_latency_s} seconds")
 
         # Write data to file
-        collection_filename = get_collection_filepath(self._collection_name)
-        mission_time: float = gps_data.timestamp.timestamp() - self._true_start_s
+        timestamp, latitude, longitude, altitude, dop = gps_data
+        mission_time: float = timestamp - self._true_start_s
 
-        if not os.path.exists(collection_filename):
-            # Create the file (with column names first)
-            column_names = ['timestamp', 'met', 'lat', 'lon', 'alt', 'dop'] + [x.short_name for x in sensor_data]
-            with open(collection_filename, 'w') as f:
-                f.write(f"{','.join(column_names)}\n")
+        if not self._header_written:
+            # Start the file with column names, written out together with the first batch of datapoints
+            self._pending_rows.append(self._header_line)
+            self._header_written = True
 
         # Format data collect as comma delimited
-        columns = [gps_data.timestamp.isoformat(), mission_time, gps_data.latitude, gps_data.longitude,
-                   gps_data.altitude, gps_data.dop] + [x.value for x in sensor_data]
-        with open(collection_filename, 'a') as f:
-            f.writelines(f"{','.join(str(x) for x in columns)}\n")
+        self._pending_rows.append(self._row_format % (datetime.fromtimestamp(timestamp, timezone.utc).isoformat(),
+                                                      mission_time,
+                                                      latitude, longitude, altitude, dop,
+                                                      *[x.value for x in sensor_data]))
+        # Batch up datapoints so the SD card sees a few large writes instead of many tiny ones
+        if (len(self._pending_rows) >= DATAPOINT_FLUSH_COUNT
+                or time.time() - self._last_flush_s > DATAPOINT_FLUSH_INTERVAL_S):
+            self._flush_pending_rows()
 
 
 # Construct a recorder representation object for later forking
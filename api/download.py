@@ -1,18 +1,56 @@
-from typing import Iterable
+from typing import Iterable, List
+from pathlib import Path
+import functools
+import zipfile
+import io
 
-from utils import get_conn, get_collection_filepath
+from utils import get_conn, DATA_DIRECTORY
 
 
+@functools.lru_cache(maxsize=1024)
 def get_collection_name_from_id(collection_id: int) -> str:
     """Get the name of a collection from the database given a collection_id"""
+    # Collection names never change after creation, so lookups are safe to cache
     db_conn = get_conn()
     cur = db_conn.cursor()
     cur.execute("SELECT name FROM collections WHERE id = ?", (collection_id,))
     return cur.fetchone()[0]
 
 
-def download_collection_data(collection_name: str) -> Iterable[str]:
-    """Stream the contents of a collection file line-by-line"""
-    with open(get_collection_filepath(collection_name), 'r') as f:
-        for line in f.readlines():
-            yield line
+# Read size used when streaming collection files to the user
+DOWNLOAD_BUFFER_SIZE: int = 1 << 20
+
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """Write-only file object that holds zip archive output until it is streamed to the user"""
+
+    def __init__(self) -> None:
+        super(_ZipStreamBuffer, self).__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self) -> bytes:
+        """Take all archive output written since the last call"""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def download_all_collection_data() -> Iterable[bytes]:
+    """Stream a zip archive of every collection file, built as it is sent"""
+    buffer = _ZipStreamBuffer()
+    # Collection files are small and the Pi's CPU is the bottleneck, so store them without compression
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for collection_path in sorted(Path(DATA_DIRECTORY).glob('*.csv')):
+            with collection_path.open('rb') as source, archive.open(collection_path.name, 'w') as destination:
+                for chunk in iter(lambda: source.read(DOWNLOAD_BUFFER_SIZE), b''):
+                    destination.write(chunk)
+                    yield buffer.pop()
+    # Emit the trailing archive directory
+    yield buffer.pop()
@@ -1,7 +1,7 @@
 from multiprocessing import Process
 import time
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timezone
+from typing import Optional, Callable, Dict
 import logging
 
 import pynmea2
@@ -16,8 +16,42 @@ GPS_I2C_BUS: int = 1
 GPS_I2C_ADDRESS: int = 0x42
 
 # Registers described in https://www.u-blox.com/en/docs/UBX-16012619
-AVAILABLE_BYTES_REGISTER: int = 0xFD
+AVAILABLE_BYTES_REGISTER: int = 0xFD  # High byte at 0xFD, low byte at 0xFE
 DATA_STREAM_REGISTER: int = 0xFF
+# Largest data stream read issued in a single I2C transaction
+GPS_MAX_READ_SIZE: int = 4096
+
+# Polling delays while the GPS has no data, doubling on each empty poll up to the maximum
+GPS_MIN_IDLE_SLEEP_S: float = 0.002
+GPS_MAX_IDLE_SLEEP_S: float = 0.05
+
+# Delays between attempts to open the bus, doubling on each failure up to the maximum, until the deadline passes
+GPS_CONNECTION_MIN_RETRY_S: float = 0.1
+GPS_CONNECTION_MAX_RETRY_S: float = 5.0
+GPS_CONNECTION_DEADLINE_S: float = 60.0
+
+
+def _utc_epoch_s(sentence_datetime: datetime) -> float:
+    """Convert a sentence's date and time into seconds since the UTC epoch"""
+    if sentence_datetime.tzinfo is None:
+        # GPS time is always UTC
+        sentence_datetime = sentence_datetime.replace(tzinfo=timezone.utc)
+    return sentence_datetime.timestamp()
+
+
+# Updates the aggregated GPS state with only the fields that each sentence type we care about carries, the float
+# casts reject sentences with empty fields
+_EXTRACTORS: Dict[str, Callable[[pynmea2.NMEASentence, GPSStatus], GPSStatus]] = {
+    'GGA': lambda sentence, state: state._replace(latitude=float(sentence.latitude),
+                                                  longitude=float(sentence.longitude),
+                                                  altitude=float(sentence.altitude)),
+    'GLL': lambda sentence, state: state._replace(latitude=float(sentence.latitude),
+                                                  longitude=float(sentence.longitude)),
+    'GSA': lambda sentence, state: state._replace(dop=float(sentence.pdop)),
+    'RMC': lambda sentence, state: state._replace(timestamp=_utc_epoch_s(sentence.datetime),
+                                                  latitude=float(sentence.latitude),
+                                                  longitude=float(sentence.longitude)),
+}
 
 
 class NoGPSData(RuntimeError):
@@ -39,72 +73,58 @@ class GPSReceiver(Process):
         """Main loop in forked process"""
         logging.info("Starting GPS Daemon")
 
-        # Aggregated state storage for parsed GPS data:
-        timestamp: datetime = datetime.utcnow()
-        latitude: float = 0.0
-        longitude: float = 0.0
-        altitude: float = 0.0
-        dop: float = 0.0
+        # Aggregated state storage for parsed GPS data
+        state = GPSStatus(timestamp=time.time(), latitude=0.0, longitude=0.0, altitude=0.0, dop=0.0)
 
         bus: Optional[smbus2.SMBus] = None
         try:
             # Connect to the I2C bus
             bus = get_gps_bus()
             logging.info("Successfully initialized GPS Daemon")
-            buffer = ''
+            # Assembles whole sentences from the byte stream and parses them, skipping any that are malformed
+            nmea_reader = pynmea2.NMEAStreamReader(errors='ignore')
+            idle_polls = 0  # Number of consecutive polls that found no data
             while True:
                 # Get new GPS data
                 try:
-                    # Ask the GPS for how much data we can read from it
-                    available_bytes = bus.read_byte_data(GPS_I2C_ADDRESS, AVAILABLE_BYTES_REGISTER)
+                    # Ask the GPS for how much data we can read from it (16 bit count) in a combined write/read
+                    count_select = smbus2.i2c_msg.write(GPS_I2C_ADDRESS, [AVAILABLE_BYTES_REGISTER])
+                    count_read = smbus2.i2c_msg.read(GPS_I2C_ADDRESS, 2)
+                    bus.i2c_rdwr(count_select, count_read)
                 except OSError:
                     # Restart the read operation
                     continue
+                count_high, count_low = bytes(count_read)
+                available_bytes = min((count_high << 8) | count_low, GPS_MAX_READ_SIZE)
                 if not available_bytes:
+                    # Back off while the GPS is between output bursts
+                    time.sleep(min(GPS_MAX_IDLE_SLEEP_S, GPS_MIN_IDLE_SLEEP_S * (1 << min(idle_polls, 5))))
+                    idle_polls += 1
                     continue
-                # Read the next block of data
-                while available_bytes > 0:
-                    # Read data in blocks of maximum 32 bytes
-                    bytes_read = min(available_bytes, 32)
+                idle_polls = 0
+                try:
+                    # The register pointer auto-increments from the byte count onto DATA_STREAM_REGISTER (and stays
+                    # there), so everything available can be read in a single transaction without re-addressing
+                    stream_read = smbus2.i2c_msg.read(GPS_I2C_ADDRESS, available_bytes)
+                    bus.i2c_rdwr(stream_read)
+                except OSError:
+                    # Restart the read operation
+                    continue
+                # Skip non-value bytes and drop any non-ASCII transport garbage
+                chunk = bytes(stream_read).translate(None, b'\xff').decode('ascii', 'ignore')
+                for sentence in nmea_reader.next(chunk):
+                    # Each sentence type contains a different selection of fields, skip those we don't care about
+                    # (proprietary sentences such as $PUBX have no sentence type)
+                    extractor = _EXTRACTORS.get(getattr(sentence, 'sentence_type', None))
+                    if extractor is None:
+                        continue
                     try:
-                        block = bus.read_i2c_block_data(GPS_I2C_ADDRESS, DATA_STREAM_REGISTER, bytes_read)
-                    except OSError:
-                        # Restart the read operation
+                        state = extractor(sentence, state)
+                    except (TypeError, ValueError):
+                        # Ignore transport errors
                         continue
-                    available_bytes -= available_bytes
-                    for b in block:
-                        if b == 0xFF:
-                            # Skip non-value bytes
-                            continue
-                        next_character = chr(b)
-                        # Buffer up characters into a string until a whole sentence is formed
-                        buffer += next_character
-                        # Sentences are separated by a newline character
-                        if next_character == '\n':
-                            try:
-                                # Attempt to parse the string
-                                sentence = pynmea2.parse(buffer)
-
-                                # Each sentence contains a different selection of fields, check that we care about
-                                timestamp = getattr(sentence, 'datetime', timestamp)
-                                # Attempt to cast the floating point values to check for parsing errors
-                                latitude = float(getattr(sentence, 'latitude', latitude))
-                                longitude = float(getattr(sentence, 'longitude', longitude))
-                                altitude = float(getattr(sentence, 'altitude', altitude))
-                                dop = float(getattr(sentence, 'pdop', dop))
-
-                                # Update the current state with the aggregated values from this and previous sessions
-                                gps_interface.set_current_state(GPSStatus(
-                                    timestamp=timestamp,
-                                    latitude=latitude,
-                                    longitude=longitude,
-                                    altitude=altitude,
-                                    dop=dop
-                                ))
-                            except (pynmea2.ChecksumError, pynmea2.ParseError, TypeError, ValueError):
-                                # Ignore transport errors
-                                pass
-                            buffer = ''
+                    # Update the current state with the aggregated values from this and previous sentences
+                    gps_interface.set_current_state(state)
                 # Don't totally consume the GIL
                 time.sleep(0.001)
         finally:
@@ -114,12 +134,18 @@ class GPSReceiver(Process):
 
 def get_gps_bus() -> smbus2.SMBus:
     """Get a connection to the local I2C bus with provided GPS sensor"""
-    for _ in range(10):
+    deadline_s = time.monotonic() + GPS_CONNECTION_DEADLINE_S
+    retry_s = GPS_CONNECTION_MIN_RETRY_S
+    while True:
         try:
             return smbus2.SMBus(GPS_I2C_BUS)
         except PermissionError:
-            # Attempt 10 times over 60 seconds
-            time.sleep(6)
+            # Retry quickly at first in case the bus is just coming up, backing off until the deadline
+            remaining_s = deadline_s - time.monotonic()
+            if remaining_s <= 0:
+                break
+            time.sleep(min(retry_s, remaining_s))
+            retry_s = min(retry_s * 2, GPS_CONNECTION_MAX_RETRY_S)
     raise RuntimeError("Could not connect to GPS bus")
 
 
@@ -0,0 +1,10 @@
+# Production web server configuration, applied by launcher.py (run from the api directory with `python3 launcher.py`)
+import multiprocessing
+
+bind = '0.0.0.0:8080'
+# One worker per Pi core, each serving requests from a pool of threads
+workers = multiprocessing.cpu_count()
+worker_class = 'gthread'
+threads = 4
+# No access log: the web app polls the status endpoints every few seconds, which would flood the log
+accesslog = None
@@ -1,58 +1,143 @@
 import multiprocessing
-from typing import Any
+from typing import Any, Callable, Optional, Type
+import ctypes
+import os
+import select
 import time
 
-from messages import SensorValue, GPSStatus, RecorderStatus
+from messages import SensorReadingsStruct, GPSStatusStruct, RecorderStatusStruct
 
-# Construct a manager server process pre-fork
-_manager = multiprocessing.Manager()
+# Longest a waiting process sleeps before re-checking the recording state on its own. Only needed when several
+# processes wait on the same interface with different predicates and one drains a wake-up the other hadn't run for yet.
+RECORDING_STATE_RECHECK_S: float = 1.0
+
+
+def _copy_struct(destination: ctypes.Structure, source: ctypes.Structure) -> None:
+    """Copy the raw memory of one ctypes structure into another of the same layout"""
+    ctypes.memmove(ctypes.addressof(destination), ctypes.addressof(source), ctypes.sizeof(source))
 
 
 class BaseInterface:
     """High level communication for performing inter-process communication"""
 
-    def __init__(self, message_type) -> None:
-        """Construct a new interface using a pre-fork message type. Messages must be imported first!"""
-        self._message_type = message_type
-        self._lock = _manager.Lock()  # State control lock
-        self._state = _manager.Namespace()  # Dynamic object for transmitting state
+    def __init__(self, state_layout: Type[ctypes.Structure]) -> None:
+        """Construct a new interface using a pre-fork shared memory layout. Messages must be imported first!"""
+        self._state_layout = state_layout
+        self._lock = multiprocessing.Lock()  # State control lock
+
+        # Common communication channels used in all processes, allocated in shared memory. Each flag is a single
+        # byte that is only ever loaded or stored whole, so the flags are accessed without the lock.
+        self._should_record = multiprocessing.RawValue(ctypes.c_bool, False)
+        self._is_recording = multiprocessing.RawValue(ctypes.c_bool, False)
+
+        # Every change to the recording state bumps the generation and writes a byte to this pipe, and waiting
+        # processes select on it. There is no handshake with the waiters (unlike a shared Condition), so a waiter that
+        # gets killed can never block the process changing the state.
+        self._state_generation = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self._wake_read_fd, self._wake_write_fd = os.pipe()
+        os.set_blocking(self._wake_read_fd, False)
+        os.set_blocking(self._wake_write_fd, False)
 
-        # Common communication channels used in all processes
-        self._state.should_record = False
-        self._state.is_recording = False
-        self._state.current_state = None
-        self._state.state_time = 0.0
+        # The current state is copied in and out of shared memory under the lock, which is only held for the copy.
+        # The lock is what orders the copy against other cores on the Pi, plain ctypes loads and stores have no
+        # memory barriers of their own.
+        self._has_state = multiprocessing.RawValue(ctypes.c_bool, False)
+        self._state = multiprocessing.RawValue(state_layout)
+        self._state_time = multiprocessing.RawValue(ctypes.c_double, 0.0)
 
     def signal_should_record(self, should_record: bool) -> None:
         """(from parent) Instruct the child process to start a recording session"""
-        with self._lock:
-            self._state.should_record = should_record
+        self._should_record.value = should_record
+        self._wake_waiters()
 
     def acknowledge_is_recording(self, is_recording: bool) -> None:
         """(from child) Acknowledge that recording has started"""
-        with self._lock:
-            self._state.is_recording = is_recording
+        self._is_recording.value = is_recording
+        self._wake_waiters()
 
     def get_recording_state(self) -> (bool, bool):
         """(from anywhere) Get the current instruction, acknowledgement of recording"""
-        with self._lock:
-            return self._state.should_record, self._state.is_recording
+        return self._should_record.value, self._is_recording.value
+
+    def wait_for_recording_state(self, predicate: Callable[[bool, bool], bool],
+                                 timeout: Optional[float]) -> (bool, bool):
+        """(from anywhere) Block until the instruction, acknowledgement of recording satisfy predicate or timeout"""
+        deadline_s = None if timeout is None else time.monotonic() + timeout
+        while True:
+            generation = self._state_generation.value
+            recording_state = self.get_recording_state()
+            if predicate(*recording_state):
+                return recording_state
+            wait_s = RECORDING_STATE_RECHECK_S
+            if deadline_s is not None:
+                remaining_s = deadline_s - time.monotonic()
+                if remaining_s <= 0:
+                    return recording_state
+                wait_s = min(wait_s, remaining_s)
+            if self._state_generation.value != generation:
+                # Changed while it was being checked
+                continue
+            readable, _, _ = select.select([self._wake_read_fd], [], [], wait_s)
+            if readable and self._state_generation.value == generation:
+                # Nothing changed since this waiter last checked, so the pending wake-ups are stale. Wake-ups for a
+                # newer change are left in place for any other waiter that hasn't seen it yet.
+                self._drain_wake_ups()
+
+    def _wake_waiters(self) -> None:
+        """Wake up any process waiting on a change to the recording state"""
+        self._state_generation.value += 1
+        try:
+            os.write(self._wake_write_fd, b'\0')
+        except BlockingIOError:
+            # The pipe is full of wake-ups that haven't been consumed yet, which will wake waiters just the same
+            pass
+
+    def _drain_wake_ups(self) -> None:
+        """Discard all wake-ups written so far"""
+        try:
+            while os.read(self._wake_read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
 
     def set_current_state(self, state_object: Any) -> None:
         """(from child) Describe the current instantaneous state"""
+        packed_state = self._state_layout.pack(state_object)
+        state_time = time.time()
         with self._lock:
-            self._state.current_state = state_object
-            self._state.state_time = time.time()
+            _copy_struct(self._state, packed_state)
+            self._state_time.value = state_time
+            self._has_state.value = True
 
     def get_current_state(self) -> (Any, float):
         """(from anywhere) Get the current state object and time of state"""
         with self._lock:
-            current_state = self._state.current_state
-            time_since_state = time.time() - self._state.state_time
-        return current_state, time_since_state
+            if not self._has_state.value:
+                return None, time.time()
+            # Snapshot the shared memory so it can be unpacked after releasing the lock
+            packed_state = self._state_layout.from_buffer_copy(self._state)
+            state_time = self._state_time.value
+        return packed_state.unpack(), time.time() - state_time
+
+
+class RecorderInterface(BaseInterface):
+    """Recorder communication, additionally tracking modifications to the stored collections"""
+
+    def __init__(self, state_layout: Type[ctypes.Structure]) -> None:
+        super(RecorderInterface, self).__init__(state_layout)
+        self._collections_version = multiprocessing.Value('Q', 0)  # Incremented on every collection change
+
+    def signal_collections_changed(self) -> None:
+        """(from anywhere) Mark the stored collection metadata as modified"""
+        with self._collections_version.get_lock():
+            self._collections_version.value += 1
+
+    def get_collections_version(self) -> int:
+        """(from anywhere) Get a counter that increases every time the stored collections are modified"""
+        return self._collections_version.value
 
 
 # Construct IPC interfaces to each of the major child processes
-sensor_interface = BaseInterface(SensorValue)
-gps_interface = BaseInterface(GPSStatus)
-recorder_interface = BaseInterface(RecorderStatus)
+sensor_interface = BaseInterface(SensorReadingsStruct)
+gps_interface = BaseInterface(GPSStatusStruct)
+recorder_interface = RecorderInterface(RecorderStatusStruct)
@@ -0,0 +1,39 @@
+import multiprocessing
+import sys
+
+from gunicorn.app.base import BaseApplication
+
+import gunicorn_conf
+import main
+
+
+class WebServer(BaseApplication):
+    """gunicorn application serving the already imported Flask app with the settings from gunicorn_conf.py"""
+
+    def load_config(self) -> None:
+        """Apply every gunicorn setting defined in gunicorn_conf.py"""
+        for key, value in vars(gunicorn_conf).items():
+            if key in self.cfg.settings:
+                self.cfg.set(key, value)
+
+    def load(self):
+        """Hand gunicorn the app imported (along with the IPC shared memory) before any process was started"""
+        return main.app
+
+
+def serve() -> None:
+    """Run the gunicorn master process until it shuts down"""
+    WebServer().run()
+
+
+if __name__ == '__main__':
+    main.start_services()
+    # The web server gets its own process, started the same way as the services so that it inherits the IPC shared
+    # memory but none of the service process handles. Otherwise gunicorn's master would reap the services as its own
+    # workers, and every worker would try to join them when it exits.
+    web_server = multiprocessing.Process(target=serve, name="WebServer")
+    web_server.start()
+    web_server.join()
+    # Stop the services too so the whole application can be restarted together
+    main.stop_services()
+    sys.exit(web_server.exitcode)
@@ -3,19 +3,23 @@ update.check_for_dependency_update()
 update.perform_database_migration()
 
 # Normal imports come after the dependency check
-from typing import Optional
+from typing import Optional, Tuple
 import logging
 import os
 import platform
 
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, Response, send_file
+import orjson
 from werkzeug import serving
 
 import data_logging
 from gps import gps_receiver
 from sensors import sensor_receiver
 import download
+from utils import get_collection_filepath
 
+# Keep the polled status endpoints out of the Flask development server's request log (gunicorn's access log is
+# disabled outright, see gunicorn_conf.py)
 parent_log_request = serving.WSGIRequestHandler.log_request
 
 
@@ -31,12 +35,24 @@ serving.WSGIRequestHandler.log_request = log_request
 # Load the filepath for the web resources from the environment variable $WEB_STATIC
 STATIC_FOLDER = os.environ.get('WEB_STATIC', '../web/build')
 
+# The hostname can't change while the service is running, so the health response is serialized once up front
+HEALTH_RESPONSE: bytes = orjson.dumps({'hostname': platform.node()})
+
+# Serialized list_collections response, tagged with the collections version it was built from (swapped in as one
+# tuple so concurrent requests never pair a body with the wrong version)
+_list_collections_cache: Tuple[Optional[int], bytes] = (None, b'')
+
 # Construct a Flask web service that automatically serves result from the static folder
 app = Flask(__name__,
             static_url_path='',
             static_folder=STATIC_FOLDER)
 
 
+def json_response(content) -> Response:
+    """Serialize an API response with orjson, which is much faster than Flask's jsonify for numeric payloads"""
+    return Response(orjson.dumps(content), mimetype='application/json')
+
+
 @app.route('/')
 @app.route('/data')
 def root():
@@ -54,7 +70,7 @@ def get_status():
     if is_collecting:
         status['elapsed_s'] = data_logging.recorder.get_elapsed_s()
         status['datapoints'] = data_logging.recorder.get_datapoints()
-    return jsonify(status)
+    return json_response(status)
 
 
 @app.route('/api/v1/live_sensors')
@@ -79,16 +95,13 @@ def get_live_sensors():
                 for s in raw_sensors
             ]
             status['latency_s'] = latency_s
-    return jsonify(status)
+    return json_response(status)
 
 
 @app.route('/api/v1/msa_status')
 def get_health():
     """Provide information about the MSA service itself"""
-    hostname = platform.node()
-    return jsonify({
-        'hostname': hostname,
-    })
+    return Response(HEALTH_RESPONSE, mimetype='application/json')
 
 
 @app.route('/api/v1/start', methods=['POST'])
@@ -114,31 +127,45 @@ def stop_recording():
 @app.route('/api/v1/list_collections')
 def list_collections():
     """List all known collections and high level metadata about each collection"""
-    return jsonify({'data': data_logging.get_collection_list()})
+    global _list_collections_cache
+    collections_version = data_logging.recorder.get_collections_version()
+    cached_version, body = _list_collections_cache
+    if cached_version != collections_version:
+        body = orjson.dumps({'data': data_logging.get_collection_list()})
+        _list_collections_cache = (collections_version, body)
+    return Response(body, mimetype='application/json')
 
 
 @app.route('/api/v1/collection/<int:collection_id>/details')
 def get_collection_details(collection_id: int):
     """Return detailed metadata and sensor values from a specific collection"""
-    return jsonify(data_logging.get_collection_details(collection_id))
+    return json_response(data_logging.get_collection_details(collection_id))
 
 
 @app.route('/api/v1/collection/<int:collection_id>/download')
 def download_collection_file(collection_id: int):
     """Download a collection csv file to the user"""
     collection_name = download.get_collection_name_from_id(collection_id)
-    response = Response(download.download_collection_data(collection_name), mimetype='text/csv')
-    # Name the file that will be emitted to the user
-    response.headers['Content-Disposition'] = f"attachment; filename={collection_name}.csv"
-    return response
+    # Hand the file itself to the server so it can be sent without passing through Python line-by-line. Flask resolves
+    # relative paths against the app root, so resolve it against the working directory like the recorder does
+    return send_file(os.path.abspath(get_collection_filepath(collection_name)),
+                     mimetype='text/csv',
+                     as_attachment=True,
+                     # Name the file that will be emitted to the user
+                     download_name=f"{collection_name}.csv")
 
 
 @app.route('/api/v1/download_all')
 def download_all():
-    raise NotImplemented
+    """Download every collection csv file to the user as a single zip archive"""
+    response = Response(download.download_all_collection_data(), mimetype='application/zip')
+    # Name the file that will be emitted to the user
+    response.headers['Content-Disposition'] = "attachment; filename=MSADATA.zip"
+    return response
 
 
-if __name__ == '__main__':
+def start_services() -> None:
+    """Start the data collection service processes, exactly once and before any requests are served"""
     # Configure logging to contain debug messages (this can be turned down later)
     logging.basicConfig(level=logging.DEBUG, format="[%(asctime)s] %(levelname)s - %(message)s")
     # Start the GPS receiver service process
@@ -147,5 +174,16 @@ if __name__ == '__main__':
     sensor_receiver.start()
     # Start the Data Logger service process. Must be started AFTER the GPS and sensor services
     data_logging.recorder.start()
-    # Start the Flask development web server
+
+
+def stop_services() -> None:
+    """Terminate the data collection service processes and wait for them to exit"""
+    for service in (data_logging.recorder, sensor_receiver, gps_receiver):
+        service.terminate()
+        service.join()
+
+
+if __name__ == '__main__':
+    start_services()
+    # Start the Flask development web server (production deployments are served by gunicorn, see launcher.py)
     app.run(host="0.0.0.0", port=8080, threaded=True)
\ No newline at end of file
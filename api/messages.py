@@ -1,5 +1,5 @@
-from typing import NamedTuple, Union
-import datetime
+from typing import NamedTuple, Union, List, Sequence
+import ctypes
 
 
 class SensorValue(NamedTuple):
@@ -12,7 +12,7 @@ class SensorValue(NamedTuple):
 
 class GPSStatus(NamedTuple):
     """Describes the value and metadata for an aggregated GPS reading"""
-    timestamp: datetime.datetime
+    timestamp: float  # Seconds since the UTC epoch
     latitude: float
     longitude: float
     altitude: float
@@ -24,3 +24,67 @@ class RecorderStatus(NamedTuple):
     collection_id: int
     collection_local_start_s: float
     collected_points: int
+
+
+# Maximum number of sensor readings that can be shared in a single state update
+MAX_SENSOR_VALUES: int = 16
+
+
+class SensorReadingsStruct(ctypes.Structure):
+    """Fixed memory layout of the values from one sensor packet for sharing between processes"""
+    _fields_ = [
+        ('count', ctypes.c_int),
+        ('values', ctypes.c_double * MAX_SENSOR_VALUES),
+        ('is_integer', ctypes.c_bool * MAX_SENSOR_VALUES),  # Restore integer readings as int rather than float
+    ]
+
+    @classmethod
+    def pack(cls, readings: Sequence[Union[float, int]]) -> 'SensorReadingsStruct':
+        """Convert the values of a sensor packet into the shared layout"""
+        packed = cls(len(readings))
+        packed.values[:len(readings)] = readings
+        packed.is_integer[:len(readings)] = [isinstance(value, int) for value in readings]
+        return packed
+
+    def unpack(self) -> List[Union[float, int]]:
+        """Convert the shared layout back into the values of a sensor packet"""
+        return [int(value) if is_integer else value
+                for value, is_integer in zip(self.values[:self.count], self.is_integer[:self.count])]
+
+
+class GPSStatusStruct(ctypes.Structure):
+    """Fixed memory layout of a GPSStatus for sharing between processes"""
+    _fields_ = [
+        ('timestamp', ctypes.c_double),  # Seconds since the UTC epoch
+        ('latitude', ctypes.c_double),
+        ('longitude', ctypes.c_double),
+        ('altitude', ctypes.c_double),
+        ('dop', ctypes.c_double),
+    ]
+
+    @classmethod
+    def pack(cls, status: GPSStatus) -> 'GPSStatusStruct':
+        """Convert a GPS reading into the shared layout"""
+        return cls(status.timestamp, status.latitude, status.longitude, status.altitude, status.dop)
+
+    def unpack(self) -> GPSStatus:
+        """Convert the shared layout back into a GPS reading"""
+        return GPSStatus(self.timestamp, self.latitude, self.longitude, self.altitude, self.dop)
+
+
+class RecorderStatusStruct(ctypes.Structure):
+    """Fixed memory layout of a RecorderStatus for sharing between processes"""
+    _fields_ = [
+        ('collection_id', ctypes.c_int64),
+        ('collection_local_start_s', ctypes.c_double),
+        ('collected_points', ctypes.c_int64),
+    ]
+
+    @classmethod
+    def pack(cls, status: RecorderStatus) -> 'RecorderStatusStruct':
+        """Convert a recorder status into the shared layout"""
+        return cls(status.collection_id, status.collection_local_start_s, status.collected_points)
+
+    def unpack(self) -> RecorderStatus:
+        """Convert the shared layout back into a recorder status"""
+        return RecorderStatus(self.collection_id, self.collection_local_start_s, self.collected_points)
@@ -1,6 +1,11 @@
 from multiprocessing import Process
-from typing import Optional, List, Callable
+from typing import Optional, List, Union
+import struct
+import select
+import termios
+import fcntl
 import time
+import os
 import logging
 
 import serial
@@ -10,69 +15,52 @@ from messages import SensorValue
 from ipc import sensor_interface
 
 
-def _unsigned_short_parser(byte_0: int, byte_1: int) -> int:
-    """Default parser to convert an unsigned short into python integer"""
-    return byte_0 * 256 + byte_1
-
-
-def _fixed_multiplier_parser(multiplier: float) -> Callable[[int, int], float]:
-    """Convert an unsigned short into a floating point with a static multiplier"""
-    def annotated_parser(byte_0: int, byte_1: int) -> float:
-        return _unsigned_short_parser(byte_0, byte_1) * multiplier
-
-    return annotated_parser
-
-
-def _celsius_parser(byte_0: int, byte_1: int) -> float:
-    """Specialized parser for temperature shorts"""
-    return float(_unsigned_short_parser(byte_0, byte_1) - 500) * 0.1
-
-
-def _unsigned_char_parser(byte_0: int) -> int:
-    """Identity parser for unsigned char"""
-    return byte_0
-
-
 class RawDataClass:
     """Representation class for parsing and identifying sensor readings"""
     def __init__(self, name: str, short_name: str, unit: str,
-                 byte_0: int, byte_1: Optional[int] = None,
-                 parser: Callable = _unsigned_short_parser) -> None:
+                 data_format: str = 'H', multiplier: Optional[float] = None, offset: int = 0) -> None:
         self.name: str = name
         self.short_name: str = short_name
         self.unit: str = unit
-        self._parser: Callable = parser
-        self._byte_0: int = byte_0
-        self._byte_1: Optional[int] = byte_1
-
-    def __call__(self, data_packet: bytes) -> SensorValue:
-        """Parse a sensor data packet to extract this particular sensor value"""
-        if self._byte_1 is None:
-            value = self._parser(data_packet[self._byte_0])
-        else:
-            value = self._parser(data_packet[self._byte_0], data_packet[self._byte_1])
-        return SensorValue(self.name, self.short_name, self.unit, value)
+        self.data_format: str = data_format  # struct format character of the raw value (unsigned short by default)
+        self.multiplier: Optional[float] = multiplier  # Raw integer is used as-is if there is no multiplier
+        self.offset: int = offset
 
 
 # Winsen datasheet: https://www.winsen-sensor.com/sensors/co2-sensor/zphs01b.html
 WINSEN_DEVICE: str = '/dev/ttyAMA0'
 WINSEN_BAUDRATE: int = 9600
-WINSEN_CONNECTION_TIMEOUT: float = 2.0
+WINSEN_CONNECTION_TIMEOUT: float = 0.05
+# Time to wait for the board to finish answering a read command
+WINSEN_RESPONSE_TIMEOUT: float = 0.2
+# Delays between attempts to open the device, doubling on each failure up to the maximum, until the deadline passes
+WINSEN_CONNECTION_MIN_RETRY_S: float = 0.1
+WINSEN_CONNECTION_MAX_RETRY_S: float = 5.0
+WINSEN_CONNECTION_DEADLINE_S: float = 60.0
+# Gap between received bytes (in tenths of a second) after which the kernel hands over a partial packet
+WINSEN_INTER_BYTE_TIMEOUT_DS: int = 1
 WINSEN_READ_COMMAND: bytes = b'\xff\x01\x86\x00\x00\x00\x00\x00\x79'
 WINSEN_RESPONSE_SIZE: int = 26
+# Sensor values in the order they are packed (big-endian) into the data packet, starting at byte 2
 WINSEN_DATAPACKET: List[RawDataClass] = [
-    RawDataClass('PM 1.0', 'pm_1_0', 'μg/m3', 2, 3),
-    RawDataClass('PM 2.5', 'pm_2_5', 'μg/m3', 4, 5),
-    RawDataClass('PM 10', 'pm_10', 'μg/m3', 6, 7),
-    RawDataClass('Carbon Dioxide', 'co2', 'ppm', 8, 9),
-    RawDataClass('VOC', 'voc', 'grade', 10, parser=_unsigned_char_parser),
-    RawDataClass('Temperature', 'temp', '°C', 11, 12, parser=_celsius_parser),
-    RawDataClass('Humidity', 'humidity', '%RH', 13, 14),
-    RawDataClass('Formaldehyde', 'ch2o', 'mg/m3', 15, 16, parser=_fixed_multiplier_parser(0.001)),
-    RawDataClass('Carbon Monoxide', 'co', 'ppm', 17, 18, parser=_fixed_multiplier_parser(0.1)),
-    RawDataClass('Ozone', 'o3', 'ppm', 19, 20, parser=_fixed_multiplier_parser(0.01)),
-    RawDataClass('Nitrogen Dioxide', 'no2', 'ppm', 21, 22, parser=_fixed_multiplier_parser(0.01)),
+    RawDataClass('PM 1.0', 'pm_1_0', 'μg/m3'),
+    RawDataClass('PM 2.5', 'pm_2_5', 'μg/m3'),
+    RawDataClass('PM 10', 'pm_10', 'μg/m3'),
+    RawDataClass('Carbon Dioxide', 'co2', 'ppm'),
+    RawDataClass('VOC', 'voc', 'grade', data_format='B'),
+    RawDataClass('Temperature', 'temp', '°C', multiplier=0.1, offset=-500),
+    RawDataClass('Humidity', 'humidity', '%RH'),
+    RawDataClass('Formaldehyde', 'ch2o', 'mg/m3', multiplier=0.001),
+    RawDataClass('Carbon Monoxide', 'co', 'ppm', multiplier=0.1),
+    RawDataClass('Ozone', 'o3', 'ppm', multiplier=0.01),
+    RawDataClass('Nitrogen Dioxide', 'no2', 'ppm', multiplier=0.01),
 ]
+# Decodes every raw sensor value of a data packet in a single call, skipping the 2 byte packet header
+_WINSEN_STRUCT = struct.Struct('>2x' + ''.join(data_class.data_format for data_class in WINSEN_DATAPACKET))
+# Conversion of each raw integer into its sensor value, flattened out of WINSEN_DATAPACKET for the parse loop
+_WINSEN_CONVERSIONS = tuple((data_class.multiplier, data_class.offset) for data_class in WINSEN_DATAPACKET)
+# Metadata of each sensor value, which never changes so is only attached when a reading is requested
+_WINSEN_METADATA = [(data_class.name, data_class.short_name, data_class.unit) for data_class in WINSEN_DATAPACKET]
 
 DATA_POLL_RATE: float = 1.0
 
@@ -85,15 +73,27 @@ class NoSensorData(RuntimeError):
     """Non-critical error to indicate that no data packets could be read"""
 
 
+def _started_collecting(should_record: bool, _: bool) -> bool:
+    """Recording state predicate for the sensor loop to wake up and start collecting"""
+    return should_record
+
+
+def _stopped_collecting(should_record: bool, _: bool) -> bool:
+    """Recording state predicate for the sensor loop to wake up and stop collecting"""
+    return not should_record
+
+
 class SensorReceiver(Process):
     """Process for receiving and parsing data from the Winsen sensor"""
 
     @staticmethod
     def get_current_status() -> (List[SensorValue], float):
         """Describe the current state of the sensor board, including last datapoint"""
-        sensor_data, latency_s = sensor_interface.get_current_state()
-        if not sensor_data:
+        sensor_readings, latency_s = sensor_interface.get_current_state()
+        if not sensor_readings:
             raise NoSensorData()
+        sensor_data = [SensorValue(name, short_name, unit, value)
+                       for (name, short_name, unit), value in zip(_WINSEN_METADATA, sensor_readings)]
         return sensor_data, latency_s
 
     @staticmethod
@@ -120,64 +120,134 @@ class SensorReceiver(Process):
 
         # Get the GPIO connection to the status LED
         collection_light = LED(16)
+        # Last state written to the LED, tracked here so the pin is never read back or rewritten unchanged
+        light_on: bool = False
 
-        # Time of last datapoint collection
-        last_read_s: float = 0.0
+        # Time the next datapoint collection is due
+        next_read_s: float = 0.0
         logging.info("Successfully initialized Sensor Daemon")
         while True:
             # Check if we should start collecting data
             should_collect, is_recording = sensor_interface.get_recording_state()
             if not should_collect:
-                if is_recording:
+                if light_on:
                     collection_light.off()
+                    light_on = False
+                if is_recording:
                     sensor_interface.acknowledge_is_recording(False)
-                time.sleep(0.1)
+                # Block until the instruction to start collecting wakes this process (the wait also re-checks the
+                # recording state by itself once every RECORDING_STATE_RECHECK_S)
+                sensor_interface.wait_for_recording_state(_started_collecting, timeout=None)
                 continue
             if not is_recording:
                 sensor_interface.acknowledge_is_recording(True)
 
-            # Check if it is time to collect a new datapoint
-            if time.time() >= (last_read_s + DATA_POLL_RATE):
-                # Toggle LED light
-                collection_light.off() if collection_light.is_active else collection_light.on()
-
-                # Instruct the sensor board to emit a data packet
-                winsen_connection.write(WINSEN_READ_COMMAND)
-                # Read the data packet from the board
-                data_packet = winsen_connection.read(WINSEN_RESPONSE_SIZE)
-                if data_packet:
-                    # Attempt to parse the packet
-                    try:
-                        sensor_values = self._parse_data_packet(data_packet)
-                    except ParseError:
-                        continue
-                    # Emit the parsed values to be recorded/visualized
-                    sensor_interface.set_current_state(sensor_values)
-                last_read_s = time.time()
-            time.sleep(0.01)
+            # Block until the next datapoint is due, or until the instruction to stop collecting wakes this process
+            wait_s = next_read_s - time.time()
+            if wait_s > 0:
+                sensor_interface.wait_for_recording_state(_stopped_collecting, timeout=wait_s)
+                continue
+            # Keep datapoints on a fixed cadence, starting a new one if collection has fallen behind (e.g. was idle)
+            next_read_s += DATA_POLL_RATE
+            if next_read_s <= time.time():
+                next_read_s = time.time() + DATA_POLL_RATE
+
+            # Toggle LED light
+            light_on = not light_on
+            collection_light.value = light_on
+
+            # Drop any partial packet left over from a previous poll so the response starts on a packet boundary
+            winsen_connection.reset_input_buffer()
+            # Instruct the sensor board to emit a data packet
+            winsen_connection.write(WINSEN_READ_COMMAND)
+            # Read the data packet from the board
+            data_packet = self._read_data_packet(winsen_connection)
+            if data_packet:
+                # Attempt to parse the packet
+                try:
+                    sensor_values = self._parse_data_packet(data_packet)
+                except ParseError:
+                    continue
+                # Emit the parsed values to be recorded/visualized
+                sensor_interface.set_current_state(sensor_values)
+
+    @staticmethod
+    def _read_data_packet(winsen_connection: serial.Serial) -> memoryview:
+        """Collect a response packet from the board as its bytes arrive, giving up once the response deadline passes"""
+        data_packet = bytearray()
+        # Read the device directly, pyserial's read only wraps the same select and read calls in Python
+        fd = winsen_connection.fileno()
+        deadline_s = time.monotonic() + WINSEN_RESPONSE_TIMEOUT
+        while len(data_packet) < WINSEN_RESPONSE_SIZE:
+            remaining_s = deadline_s - time.monotonic()
+            if remaining_s <= 0:
+                break
+            # Sleep until more of the response has arrived
+            readable, _, _ = select.select([fd], [], [], remaining_s)
+            if not readable:
+                break
+            try:
+                # The kernel holds the read until the rest of the packet has arrived (see _configure_packet_reads)
+                data_packet += os.read(fd, WINSEN_RESPONSE_SIZE - len(data_packet))
+            except BlockingIOError:
+                # Device is still non-blocking and the data was already taken
+                continue
+        # The input buffer is reset before every command, so any bytes past the packet can be dropped
+        return memoryview(data_packet)[:WINSEN_RESPONSE_SIZE]
 
     @staticmethod
-    def _parse_data_packet(raw_packet: bytes) -> List[SensorValue]:
+    def _parse_data_packet(raw_packet: memoryview) -> List[Union[float, int]]:
         """Parse a raw data packet into human-readable values"""
-        sensor_values = []
-        for data_class in WINSEN_DATAPACKET:
-            # Run data packet through the parser for each known sensor representation
-            sensor_values.append(data_class(raw_packet))
-        return sensor_values
+        if len(raw_packet) < WINSEN_RESPONSE_SIZE:
+            # Packet was cut short
+            raise ParseError()
+        # The last byte is the two's complement of the sum of every byte between it and the start byte
+        if (0x100 - sum(raw_packet[1:WINSEN_RESPONSE_SIZE - 1])) & 0xFF != raw_packet[WINSEN_RESPONSE_SIZE - 1]:
+            raise ParseError()
+        raw_values = _WINSEN_STRUCT.unpack_from(raw_packet)
+        # Run each raw value through the conversion for its known sensor representation
+        return [raw_value if multiplier is None else (raw_value + offset) * multiplier
+                for (multiplier, offset), raw_value in zip(_WINSEN_CONVERSIONS, raw_values)]
+
+
+def _configure_packet_reads(winsen_connection: serial.Serial) -> None:
+    """Have each read of the serial device return once a whole packet has arrived or the line goes quiet"""
+    fd = winsen_connection.fileno()
+    iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd)
+    cc[termios.VMIN] = WINSEN_RESPONSE_SIZE
+    cc[termios.VTIME] = WINSEN_INTER_BYTE_TIMEOUT_DS
+    termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, ispeed, ospeed, cc])
+    # VMIN and VTIME only apply to blocking reads, reads are still only issued once select reports data
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
 
 
 def get_winsen_connection() -> serial.Serial:
     """Get the UART serial connection interface for the Winsen board"""
-    for _ in range(10):
+    deadline_s = time.monotonic() + WINSEN_CONNECTION_DEADLINE_S
+    retry_s = WINSEN_CONNECTION_MIN_RETRY_S
+    while True:
         try:
             winsen_connection = serial.Serial(port=WINSEN_DEVICE,
                                               baudrate=WINSEN_BAUDRATE,
                                               timeout=WINSEN_CONNECTION_TIMEOUT,
                                               writeTimeout=WINSEN_CONNECTION_TIMEOUT)
+            try:
+                # Have the UART driver hand over received bytes immediately instead of batching them
+                winsen_connection.set_low_latency_mode(True)
+            except (ValueError, NotImplementedError):
+                logging.warning("Could not enable low latency mode on Winsen device")
+            try:
+                _configure_packet_reads(winsen_connection)
+            except (termios.error, OSError):
+                logging.warning("Could not configure packet reads on Winsen device")
             return winsen_connection
         except serial.serialutil.SerialException:
-            # Attempt to connect 10 times over 60 seconds
-            time.sleep(6)
+            # Retry quickly at first in case the device is just coming up, backing off until the deadline
+            remaining_s = deadline_s - time.monotonic()
+            if remaining_s <= 0:
+                break
+            time.sleep(min(retry_s, remaining_s))
+            retry_s = min(retry_s * 2, WINSEN_CONNECTION_MAX_RETRY_S)
     raise RuntimeError("Could not connect to Winsen device")
 
 
@@ -1,7 +1,10 @@
 # This file should be Python3 stdlib only
 
 from pathlib import Path
+import functools
 import subprocess
+import errno
+import select
 import socket
 
 
@@ -12,14 +15,23 @@ NETWORK_ATTEMPT_TIMEOUT: float = 3.0
 def _can_connect_to_internet() -> bool:
     """Check if the Pi is currently hardwired to the internet"""
     try:
-        socket.setdefaulttimeout(NETWORK_ATTEMPT_TIMEOUT)
-        # Ping the DNS server
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect(('8.8.8.8', 53))
-        return True
-    except:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as dns_socket:
+            # Ping the DNS server without blocking, then wait for the connection attempt to resolve
+            dns_socket.setblocking(False)
+            connect_result = dns_socket.connect_ex(('8.8.8.8', 53))
+            if connect_result == 0:
+                return True
+            if connect_result != errno.EINPROGRESS:
+                # Failed immediately, e.g. there is no route to the internet at all
+                return False
+            _, writable, _ = select.select([], [dns_socket], [], NETWORK_ATTEMPT_TIMEOUT)
+            # The socket also becomes writable when the connection fails, so check how it resolved
+            return bool(writable) and dns_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+    except OSError:
         return False
 
 
+@functools.lru_cache(maxsize=1)
 def _get_application_root() -> Path:
     """Get the root directory of the MSAv2 data logging application"""
     api_directory: Path = Path(__file__).resolve().parent
@@ -41,14 +53,23 @@ def check_for_dependency_update() -> None:
 def perform_database_migration() -> None:
     """Run any SQL scripts on the local database"""
     try:
+        # Database dependencies may not be installed yet, so they are only imported once needed
+        import pysqlite3
         from utils import get_conn
+    except ImportError:
+        print("WARNING: Database dependencies unavailable for migration. Attempting to run anyway")
+        return
+    root_directory = _get_application_root()
+    sql_directory = root_directory / 'sql'
+    try:
+        # Apply every script in name order as a single transaction
+        migration_script = ';\n'.join(sql_file.read_text() for sql_file in sorted(sql_directory.glob('*.sql')))
         db_conn = get_conn()
-        cur = db_conn.cursor()
-        root_directory = _get_application_root()
-        sql_directory = root_directory / 'sql'
-        for sql_file in list(sql_directory.glob('*.sql')):
-            with sql_file.open('r') as f:
-                for result in cur.executescript(f.read()):
-                    print(result)
-    except:
+        try:
+            db_conn.executescript(f"BEGIN;\n{migration_script};\nCOMMIT;")
+        except pysqlite3.Error:
+            if db_conn.in_transaction:
+                db_conn.rollback()
+            raise
+    except (OSError, pysqlite3.Error):
         print("WARNING: Failed during database migration. Attempting to run anyway")
@@ -1,4 +1,6 @@
 from pathlib import Path
+from typing import Optional
+import functools
 import os
 
 import pysqlite3
@@ -7,7 +9,12 @@ import pysqlite3
 # Get the location to store collection files from the environment variable $DATA_DIRECTORY
 DATA_DIRECTORY: str = os.environ.get("DATA_DIRECTORY", ".")
 
+# Database connection reused for the lifetime of the process that opened it
+_conn: Optional[pysqlite3.Connection] = None
+_conn_pid: Optional[int] = None
 
+
+@functools.lru_cache(maxsize=1)
 def get_application_root() -> Path:
     """Get the root directory of the MSAv2 application"""
     api_directory: Path = Path(__file__).resolve().parent
@@ -20,5 +27,16 @@ def get_collection_filepath(collection_name: str) -> str:
 
 
 def get_conn():
-    """Connect to the local database and return a connection object"""
-    return pysqlite3.connect(f"{str(get_application_root())}/storage.db")
+    """Get this process's connection to the local database, connecting on first use"""
+    global _conn, _conn_pid
+    # Connections must not be shared across a fork, so each process opens its own
+    if _conn is None or _conn_pid != os.getpid():
+        # Autocommit connection shared by all threads of the process (the web server uses a thread per request)
+        _conn = pysqlite3.connect(f"{str(get_application_root())}/storage.db",
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        # Write-ahead logging with relaxed syncing avoids an fsync of the SD card on every statement
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn_pid = os.getpid()
+    return _conn
@@ -0,0 +1,5 @@
+#!/usr/bin/env bash
+
+set -ex
+pushd "$(dirname "$0")/api"
+exec python3 launcher.py